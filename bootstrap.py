@@ -1,20 +1,46 @@
 #!/usr/bin/env python3
 
 import argparse
+import concurrent.futures
+import functools
+import hashlib
+import io
 import logging
 import os
 import platform
-import re
+import queue
+import shutil
 import subprocess
 import sys
 import tarfile
+import threading
 import types
 import urllib.request
 
 ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 CHROMIUM_URL = 'https://github.com/chrohime/chromium_source_tarball/releases/download'
+# Read the multi-GB tarball in large chunks to reduce syscalls.
+BUFFER_SIZE = 1 << 20
+# Toolchain hooks that other hooks may depend on, or that write into the same
+# dirs, which are run sequentially in DEPS order before the rest are run in
+# parallel. The clang hook wipes third_party/llvm-build which the objdump,
+# clang_tidy, clangd, etc hooks then unpack into with the same update.py.
+TOOLCHAIN_HOOKS = ( 'win_toolchain', 'mac_toolchain', 'sysroot' )
+TOOLCHAIN_SCRIPTS = ( 'tools/clang/scripts/update.py',
+                      'tools/rust/update_rust.py' )
+
+def is_toolchain_hook(hook):
+  if (hook.name or '').startswith(TOOLCHAIN_HOOKS):
+    return True
+  return any(arg.replace('\\', '/').endswith(TOOLCHAIN_SCRIPTS)
+             for arg in hook.action)
 
 def add_depot_tools_to_path(src_dir):
+  # Child processes inherit the env, do not prepend to PATH again when this
+  # has been done for the same src dir.
+  if os.environ.get('_CHROMIUM_PATH_APPLIED') == os.path.abspath(src_dir):
+    return
+  os.environ['_CHROMIUM_PATH_APPLIED'] = os.path.abspath(src_dir)
   os.environ['DEPOT_TOOLS_UPDATE'] = '0'
   os.environ['CHROMIUM_BUILDTOOLS_PATH'] = os.path.join(os.path.abspath(src_dir), 'buildtools')
   os.environ['PATH'] = os.pathsep.join([
@@ -28,6 +54,7 @@ def add_depot_tools_to_path(src_dir):
   os.environ['GYP_MSVS_HASH_27370823e7'] = '28622d16b1'
   os.environ['GYP_MSVS_HASH_7393122652'] = '3ba76c5c20'
 
+@functools.cache
 def current_os():
   if sys.platform.startswith('linux'):
     return 'linux'
@@ -38,6 +65,7 @@ def current_os():
   else:
     raise ValueError(f'Unsupported platform: {sys.platform}')
 
+@functools.cache
 def current_cpu():
   arch = platform.machine().lower()
   if arch == 'amd64' or arch == 'x86_64' or arch == 'x64':
@@ -49,19 +77,187 @@ def current_cpu():
   else:
     raise ValueError(f'Unrecognized CPU architecture: {arch}')
 
-def download_and_extract(url, extract_path):
-  def track_progress(members):
-    for index, member in enumerate(members):
-      if (index + 1) % 5000 == 0:
+class PrefetchReader(io.RawIOBase):
+  # Read the stream from a separate thread, so the download continues while
+  # the consumer is busy decompressing and extracting.
+  def __init__(self, raw, queue_size=64):
+    super().__init__()
+    self._queue = queue.Queue(maxsize=queue_size)
+    self._stopped = threading.Event()
+    self._chunk = memoryview(b'')
+    self._eof = False
+    self._error = None
+    self._thread = threading.Thread(target=self._prefetch, args=(raw,),
+                                    daemon=True)
+    self._thread.start()
+
+  def _prefetch(self, raw):
+    try:
+      with raw:
+        while not self._stopped.is_set():
+          chunk = raw.read(BUFFER_SIZE)
+          self._queue.put(chunk)
+          if not chunk:
+            break
+    except Exception as e:
+      self._queue.put(e)
+
+  def readable(self):
+    return True
+
+  def readinto(self, b):
+    if not self._chunk:
+      # The prefetch thread has exited after the EOF or error, and callers
+      # like tarfile may read again after ignoring the error.
+      if self._error:
+        raise self._error
+      if self._eof:
+        return 0
+      chunk = self._queue.get()
+      if isinstance(chunk, Exception):
+        self._error = chunk
+        raise chunk
+      if not chunk:
+        self._eof = True
+        return 0
+      self._chunk = memoryview(chunk)
+    size = min(len(b), len(self._chunk))
+    b[:size] = self._chunk[:size]
+    self._chunk = self._chunk[size:]
+    return size
+
+  def close(self):
+    if not self.closed:
+      # Unblock the prefetch thread if it is waiting for a free slot.
+      self._stopped.set()
+      while self._thread.is_alive():
+        try:
+          self._queue.get(timeout=0.1)
+        except queue.Empty:
+          pass
+    super().close()
+
+class FastTarFile(tarfile.TarFile):
+  # Skip restoring owners and modification times of extracted files, which
+  # saves a few syscalls per file and is not needed for a fresh source tree.
+  def chown(self, tarinfo, targetpath, numeric_owner):
+    pass
+
+  def utime(self, tarinfo, targetpath):
+    pass
+
+def extract_tarball(stream, extract_path):
+  def extract(fileobj, mode):
+    # Print progress from a separate thread instead of hooking every member.
+    done = threading.Event()
+    def track_progress():
+      while not done.wait(2):
         print('.', end='', flush=True)
-      yield member
-  stream = urllib.request.urlopen(url)
-  # Set errorlevel=0 because the tarball may include linux symbolic links that
-  # do not exist on current platform.
-  with tarfile.open(fileobj=stream, mode='r|xz', errorlevel=0) as tar:
-    tar.extractall(path=extract_path,
-                   members=track_progress(tar),
-                   filter='data')
+    progress = threading.Thread(target=track_progress, daemon=True)
+    progress.start()
+    if os.environ.get('CHROMIUM_FAST_EXTRACT'):
+      tar_class = FastTarFile
+    else:
+      tar_class = tarfile.TarFile
+    # Set errorlevel=0 because the tarball may include linux symbolic links
+    # that do not exist on current platform.
+    try:
+      with tar_class.open(fileobj=fileobj, mode=mode, errorlevel=0) as tar:
+        tar.extractall(path=extract_path, filter='data')
+    finally:
+      done.set()
+      progress.join()
+  xz = shutil.which('xz')
+  if not xz:
+    with PrefetchReader(stream) as reader:
+      extract(reader, 'r|xz')
+    return
+  # Decompress with a multi-threaded xz process, which is fed by a separate
+  # thread so downloading, decompressing and extracting happen concurrently.
+  process = subprocess.Popen([ xz, '-T0', '-d', '-c' ],
+                             stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                             bufsize=BUFFER_SIZE)
+  errors = []
+  def feed():
+    try:
+      with stream, process.stdin:
+        shutil.copyfileobj(stream, process.stdin, length=BUFFER_SIZE)
+    except BrokenPipeError:
+      # xz has exited, which is reported by its return code.
+      pass
+    except Exception as e:
+      errors.append(e)
+  feeder = threading.Thread(target=feed, daemon=True)
+  feeder.start()
+  try:
+    extract(process.stdout, 'r|')
+    # Drain the padding after the end of archive so xz can exit cleanly.
+    while process.stdout.read(BUFFER_SIZE):
+      pass
+  except BaseException:
+    process.kill()
+    process.wait()
+    # The feeder may be stuck reading a stalled download, which must not
+    # block Ctrl-C, only give it a moment to report a download error.
+    feeder.join(timeout=1)
+    if errors:
+      raise errors[0]
+    raise
+  finally:
+    process.stdout.close()
+  feeder.join()
+  if errors:
+    raise errors[0]
+  if process.wait() != 0:
+    raise subprocess.CalledProcessError(process.returncode, xz)
+
+def download_and_extract(url, extract_path):
+  stream = io.BufferedReader(urllib.request.urlopen(url),
+                             buffer_size=BUFFER_SIZE)
+  extract_tarball(stream, extract_path)
+
+def download_to_cache(url, cache_dir):
+  tarball = os.path.join(cache_dir, os.path.basename(url))
+  if os.path.isfile(tarball):
+    request = urllib.request.Request(url, method='HEAD')
+    try:
+      with urllib.request.urlopen(request) as response:
+        size = int(response.headers.get('Content-Length', -1))
+    except OSError as e:
+      # Cached tarballs are only written after complete downloads, so it is
+      # safe to use when offline or when the server rejects HEAD.
+      print(f'Unable to check {url} ({e}), using cached {tarball}')
+      return tarball
+    if size == os.path.getsize(tarball):
+      return tarball
+  # Download to a temporary file first so an interrupted download is never
+  # taken as cached.
+  os.makedirs(cache_dir, exist_ok=True)
+  with urllib.request.urlopen(url) as response, \
+       open(tarball + '.part', 'wb') as f:
+    shutil.copyfileobj(response, f, length=BUFFER_SIZE)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tarball + '.part', tarball)
+  return tarball
+
+def get_deps_stamp(args):
+  with open(os.path.join(args.src_dir, 'DEPS'), 'rb') as f:
+    deps_hash = hashlib.sha1(f.read()).hexdigest()
+  return (f'{deps_hash} {current_os()} {current_cpu()} '
+          f'{args.target_os} {args.target_cpu}')
+
+def read_stamp(stamp_path):
+  try:
+    with open(stamp_path, 'r') as f:
+      return f.read()
+  except FileNotFoundError:
+    return None
+
+def write_stamp(stamp_path, stamp):
+  with open(stamp_path + '.tmp', 'w') as f:
+    f.write(stamp)
+  os.replace(stamp_path + '.tmp', stamp_path)
 
 def main():
   parser = argparse.ArgumentParser()
@@ -73,9 +269,22 @@ def main():
                       help='Target CPU architecture')
   parser.add_argument('--target-os', default=current_os(),
                       help='Target operating system (win, mac, or linux)')
+  parser.add_argument('--cache-dir',
+                      help='Keep downloaded tarballs in this dir and reuse '
+                           'them, e.g. ~/.cache/build_chromium')
+  parser.add_argument('--force', action='store_true',
+                      help='Sync deps even if DEPS has not changed')
   parser.add_argument('--verbose', action='store_true')
   args = parser.parse_args()
 
+  # Number of parallel jobs when syncing deps and running hooks, can be capped
+  # with the CHROMIUM_BOOTSTRAP_JOBS env on shared machines.
+  jobs = os.environ.get('CHROMIUM_BOOTSTRAP_JOBS', '12')
+  try:
+    jobs = max(1, int(jobs))
+  except ValueError:
+    parser.error(f'Invalid CHROMIUM_BOOTSTRAP_JOBS: {jobs}')
+
   if not args.revision and not args.tarball_url:
     print('Must specify either --revision or --tarball-url.')
     return 1
@@ -87,20 +296,40 @@ def main():
 
   # Download source tarball.
   if not os.path.isdir(args.src_dir):
-    tarball_dir = os.path.basename(tarball_url)[:-7]
+    # Extract next to the src dir so it can be renamed within the same
+    # filesystem.
+    extract_path = os.path.dirname(os.path.abspath(args.src_dir))
+    tarball_dir = os.path.join(extract_path,
+                               os.path.basename(tarball_url)[:-7])
     if os.path.isdir(tarball_dir):
       print(f'Unable to download tarball since {tarball_dir} exists.')
       return 1
 
-    print('Download and extract', tarball_dir, end='', flush=True)
-    download_and_extract(tarball_url, '.')
+    if args.cache_dir:
+      print('Download', tarball_url)
+      tarball = download_to_cache(tarball_url,
+                                  os.path.expanduser(args.cache_dir))
+      print('Extract', tarball_dir, end='', flush=True)
+      extract_tarball(open(tarball, 'rb', buffering=BUFFER_SIZE),
+                      extract_path)
+    else:
+      print('Download and extract', tarball_dir, end='', flush=True)
+      download_and_extract(tarball_url, extract_path)
     print('Done')
 
-    os.rename(tarball_dir, args.src_dir)
+    os.replace(tarball_dir, args.src_dir)
 
   host_os = current_os()
   host_cpu = current_cpu()
 
+  # The deps and hooks only depend on DEPS and the platforms, skip syncing
+  # them if nothing changed since last successful sync.
+  stamp_path = os.path.join(args.src_dir, '.bootstrap-stamp')
+  stamp = get_deps_stamp(args)
+  if not args.force and read_stamp(stamp_path) == stamp:
+    print('Deps are up to date.')
+    return
+
   # Bootstrap depot_tools.
   depot_tools_path = os.path.join(args.src_dir, 'third_party/depot_tools')
   add_depot_tools_to_path(args.src_dir)
@@ -154,14 +383,16 @@ def main():
     def root_dir(self):
       return os.path.dirname(args.src_dir)
 
-    @property
+    # The target os/cpu are queried by every dependency through their parents
+    # when evaluating conditions, so only compute them once.
+    @functools.cached_property
     def target_os(self):
       # Old gclient versions require unix for linux.
       g_target_os = 'unix' if args.target_os == 'linux' else args.target_os
       g_host_os = 'unix' if host_os == 'linux' else host_os
       return tuple(set([g_target_os, g_host_os]))
 
-    @property
+    @functools.cached_property
     def target_cpu(self):
       return tuple(set([args.target_cpu, host_cpu]))
 
@@ -183,7 +414,7 @@ def main():
   gclient = MyGClient(options)
   gclient.ParseDepsFile()
   work_queue = gclient_utils.ExecutionQueue(
-      12,
+      jobs,
       Progress('Syncing deps', 1),
       ignore_requirements=True)
   for dep in gclient.dependencies:
@@ -199,12 +430,21 @@ def main():
     gclient._cipd_root.run('update')
 
   # Run hooks.
-  for hook in gclient.GetHooks(options):
-    if hook.name not in ['lastchange',
-                         'gpu_lists_version',
-                         'lastchange_skia',
-                         'lastchange_dawn']:
-      hook.run()
+  hooks = [ hook for hook in gclient.GetHooks(options)
+            if hook.name not in ['lastchange',
+                                 'gpu_lists_version',
+                                 'lastchange_skia',
+                                 'lastchange_dawn'] ]
+  toolchain_hooks = [ hook for hook in hooks if is_toolchain_hook(hook) ]
+  for hook in toolchain_hooks:
+    hook.run()
+  with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as executor:
+    futures = [ executor.submit(hook.run) for hook in hooks
+                if hook not in toolchain_hooks ]
+    for future in futures:
+      future.result()
+
+  write_stamp(stamp_path, stamp)
 
 if __name__ == '__main__':
   exit(main())
@@ -1,19 +1,28 @@
 #!/usr/bin/env python3
 
 import argparse
+import collections
 import os
 import subprocess
 import sys
 
 from bootstrap import ROOT_DIR, add_depot_tools_to_path, current_os
 
+GnConfig = collections.namedtuple('GnConfig', [ 'use_reclient', 'use_goma' ])
+
 def get_gn_config(args):
   args_gn = os.path.join(args.out_dir, 'args.gn')
   if not os.path.isabs(args_gn):
     args_gn = os.path.join(args.src_dir, args_gn)
+  use_reclient = use_goma = False
   with open(args_gn, 'r') as f:
-    content = f.read()
-    return ('use_remoteexec = true' in content, 'goma.gn' in content)
+    for line in f:
+      line = line.strip()
+      if line.startswith('#'):
+        continue
+      use_reclient = use_reclient or line.startswith('use_remoteexec = true')
+      use_goma = use_goma or 'goma.gn' in line
+  return GnConfig(use_reclient=use_reclient, use_goma=use_goma)
 
 def main():
   parser = argparse.ArgumentParser(description='Build Chromium')
@@ -26,22 +35,23 @@ def main():
   args, unknown_args = parser.parse_known_args()
 
   add_depot_tools_to_path(args.src_dir)
+  host_os = current_os()
 
   # The python binary used for building is likely the downloaded binary in
   # depot_tools, which does not import modules installed in user's python
   # dir. Export the PYTHONPATH env so modules like pyyaml can be found.
-  if current_os() == 'win':
+  if host_os == 'win':
     site_packages = []
     for path in sys.path:
       if path.endswith('site-packages'):
         site_packages.append(path)
     os.environ['PYTHONPATH'] = os.pathsep.join(site_packages)
 
-  autoninja = 'autoninja.bat' if current_os() == 'win' else 'autoninja'
+  autoninja = 'autoninja.bat' if host_os == 'win' else 'autoninja'
   ninja_args = [ autoninja,  '-C', args.out_dir ]
 
-  use_reclient, use_goma = get_gn_config(args)
-  if use_reclient or use_goma:
+  gn_config = get_gn_config(args)
+  if gn_config.use_reclient or gn_config.use_goma:
     ninja_args += [ '-j', '200' ]
 
   try:
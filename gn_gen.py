@@ -10,13 +10,20 @@ from bootstrap import ROOT_DIR, add_depot_tools_to_path, current_cpu, current_os
 def gn_gen(src_dir, out_dir, args):
   joined_args = ' '.join(args)
   gn_bin = 'gn.bat' if current_os() == 'win' else 'gn'
-  process = subprocess.Popen([ gn_bin, 'gen', out_dir, f'--args={joined_args}'],
-                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
-                             text=True, cwd=src_dir)
-  for line in process.stdout:
-    if '.gclient_entries missing' not in line:
-      print(line.strip())
-  process.wait()
+  return subprocess.Popen([ gn_bin, 'gen', out_dir, f'--args={joined_args}'],
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                          bufsize=1 << 16, cwd=src_dir)
+
+def print_output(process):
+  # Filter the whole output at once instead of line by line.
+  with process.stdout:
+    output = process.stdout.read()
+  lines = [ line for line in output.splitlines(keepends=True)
+            if b'.gclient_entries missing' not in line ]
+  sys.stdout.flush()
+  sys.stdout.buffer.write(b''.join(lines))
+  sys.stdout.buffer.flush()
+  return process.wait()
 
 def main():
   parser = argparse.ArgumentParser(description='Generate GN build config')
@@ -48,25 +55,34 @@ def main():
 
   generate_all = not args.config and not args.custom_config
 
+  # The configs are written to different dirs and can be generated in
+  # parallel.
+  processes = []
   if generate_all or args.config == 'Component':
-    gn_gen(args.src_dir, 'out/Component', args.arg + [
+    processes.append(gn_gen(args.src_dir, 'out/Component', args.arg + [
         'is_component_build=true',
         'is_debug=false',
-    ])
+    ]))
   if generate_all or args.config == 'Release':
-    gn_gen(args.src_dir, 'out/Release', args.arg + [
+    processes.append(gn_gen(args.src_dir, 'out/Release', args.arg + [
         'is_component_build=false',
         'is_debug=false',
         'chrome_pgo_phase=0',
         'is_official_build=true',
-    ])
+    ]))
   if generate_all or args.config == 'Debug':
-    gn_gen(args.src_dir, 'out/Debug', args.arg + [
+    processes.append(gn_gen(args.src_dir, 'out/Debug', args.arg + [
         'is_component_build=true',
         'is_debug=true',
-    ])
+    ]))
   if args.custom_config:
-    gn_gen(args.src_dir, f'out/{args.custom_config}', args.arg)
+    processes.append(gn_gen(args.src_dir, f'out/{args.custom_config}',
+                            args.arg))
+
+  # Print outputs in order, the later processes keep running meanwhile.
+  returncodes = [ print_output(process) for process in processes ]
+  if any(returncodes):
+    return 1
 
 if __name__ == '__main__':
-  main()
+  exit(main())